@@ -5,7 +5,8 @@ import os
 import dotenv
 import time
 import threading
-import functions as f
+import functools
+import uuid
 
 class Firebase:
     def __init__(self, load_env=True, verify_ssl=False):
@@ -30,10 +31,16 @@ class Firebase:
             self.computer_name = socket.gethostname()
             self.base_url = f"https://{self.project_id}-default-rtdb.firebaseio.com"
             self.verify_ssl = verify_ssl
+            # One session for every request, so its connection is reused instead of a new TLS handshake each call
+            self._session = requests.Session()
             
             # For task polling
             self._polling_thread = None
-            self._polling_active = False
+            # Set while polling is stopped. The polling thread waits on it, so stopping wakes it straight away
+            self._stop_polling = threading.Event()
+            self._stop_polling.set()
+            # Makes checking and changing the polling state one step
+            self._polling_lock = threading.Lock()
             self._task_handlers = {}
             
             # Update descriptor if available
@@ -66,7 +73,7 @@ class Firebase:
         if hasattr(self, 'descriptor') and self.descriptor:
             data["descriptor"] = self.descriptor
         
-        response = requests.put(url, json=data, params=params, verify=self.verify_ssl)
+        response = self._session.put(url, json=data, params=params, verify=self.verify_ssl)
         
         if response.status_code == 200:
             print(f"Set status for {self.computer_name} to '{status}'")
@@ -86,7 +93,7 @@ class Firebase:
         url = f"{self.base_url}/devices/{self.computer_name}/tasks.json"
         params = {"auth": self.api_key}
         
-        response = requests.get(url, params=params, verify=self.verify_ssl)
+        response = self._session.get(url, params=params, verify=self.verify_ssl)
         
         if response.status_code == 200:
             tasks = response.json()
@@ -96,7 +103,7 @@ class Firebase:
             print(response.text)
             return {}
     
-    def add_task_to_computer(self, target_computer, task_type, task_params=None):
+    def add_task_to_computer(self, target_computer, task_type, task_params=None, priority=0):
         """
         Add a task to another computer's queue
         
@@ -104,6 +111,7 @@ class Firebase:
             target_computer (str): Name of the computer to add the task to
             task_type (str): Type of task to add
             task_params (any): Parameters for the task
+            priority (int): Higher priority tasks are handled first
             
         Returns:
             dict: Response from Firebase
@@ -111,21 +119,22 @@ class Firebase:
         url = f"{self.base_url}/devices/{target_computer}/tasks.json"
         params = {"auth": self.api_key}
         
-        # Generate a unique task ID based on timestamp
-        import time
-        task_id = f"task_{int(time.time() * 1000)}"
+        # Generate a task ID from the timestamp, so tasks still sort by age, with a random suffix
+        # so adds in the same millisecond (from any thread or computer) don't overwrite each other
+        task_id = f"task_{int(time.time() * 1000)}_{uuid.uuid4().hex[:8]}"
         
         data = {
             task_id: {
                 "type": task_type,
                 "params": task_params,
                 "status": "pending",
+                "priority": priority,
                 "created_by": self.computer_name,
                 "created_at": {".sv": "timestamp"}
             }
         }
         
-        response = requests.patch(url, json=data, params=params, verify=self.verify_ssl)
+        response = self._session.patch(url, json=data, params=params, verify=self.verify_ssl)
         
         if response.status_code == 200:
             print(f"Added task {task_type} to {target_computer}")
@@ -146,27 +155,41 @@ class Firebase:
         Returns:
             bool: True if successful, False otherwise
         """
-        url = f"{self.base_url}/devices/{self.computer_name}/tasks/{task_id}.json"
-        params = {"auth": self.api_key}
-        
-        # Delete the task
-        response = requests.delete(url, params=params, verify=self.verify_ssl)
+        return self.complete_tasks({task_id: result})
+
+    def complete_tasks(self, results):
+        """
+        Mark several tasks as completed and remove them from the queue in one request
         
-        if response.status_code == 200:
-            print(f"Completed and removed task {task_id}")
+        Args:
+            results (dict): Result data by task ID, None for tasks with no result to store
             
-            # If there's a result, store it in a completed_tasks collection
+        Returns:
+            bool: True if successful, False otherwise
+        """
+        if not results:
+            return True
+
+        url = f"{self.base_url}/.json"
+        params = {"auth": self.api_key}
+        
+        # A multi-path update deletes every task and stores every result atomically
+        data = {}
+        for task_id, result in results.items():
+            data[f"devices/{self.computer_name}/tasks/{task_id}"] = None
             if result is not None:
-                completed_url = f"{self.base_url}/completed_tasks/{self.computer_name}/{task_id}.json"
-                completed_data = {
+                data[f"completed_tasks/{self.computer_name}/{task_id}"] = {
                     "result": result,
                     "completed_at": {".sv": "timestamp"}
                 }
-                requests.put(completed_url, json=completed_data, params=params, verify=self.verify_ssl)
-                
+        
+        response = self._session.patch(url, json=data, params=params, verify=self.verify_ssl)
+        
+        if response.status_code == 200:
+            print(f"Completed and removed tasks {', '.join(results)}")
             return True
         else:
-            print(f"Error completing task: {response.status_code}")
+            print(f"Error completing tasks: {response.status_code}")
             print(response.text)
             return False
             
@@ -183,7 +206,7 @@ class Firebase:
         url = f"{self.base_url}/devices/{computer_name}.json"
         params = {"auth": self.api_key}
         
-        response = requests.get(url, params=params, verify=self.verify_ssl)
+        response = self._session.get(url, params=params, verify=self.verify_ssl)
         
         if response.status_code == 200:
             return response.json()
@@ -202,7 +225,7 @@ class Firebase:
         url = f"{self.base_url}/devices.json"
         params = {"auth": self.api_key, "shallow": "true"}
         
-        response = requests.get(url, params=params, verify=self.verify_ssl)
+        response = self._session.get(url, params=params, verify=self.verify_ssl)
         
         if response.status_code == 200:
             devices = response.json()
@@ -223,7 +246,7 @@ class Firebase:
         params = {"auth": self.api_key}
         
         # First check if the descriptor already exists and matches current value
-        response = requests.get(url, params=params, verify=self.verify_ssl)
+        response = self._session.get(url, params=params, verify=self.verify_ssl)
         
         if response.status_code == 200:
             current_data = response.json()
@@ -235,7 +258,7 @@ class Firebase:
         
         # Update the descriptor
         data = {"descriptor": self.descriptor}
-        response = requests.patch(url, json=data, params=params, verify=self.verify_ssl)
+        response = self._session.patch(url, json=data, params=params, verify=self.verify_ssl)
         
         if response.status_code == 200:
             print(f"Updated descriptor for {self.computer_name} to '{self.descriptor}'")
@@ -255,20 +278,21 @@ class Firebase:
         Returns:
             bool: True if polling started, False if already running
         """
-        if self._polling_active:
-            print("Task polling is already active")
-            return False
-        
-        self._polling_active = True
-        self._default_handler = default_handler
-        
-        # Create and start the polling thread
-        self._polling_thread = threading.Thread(
-            target=self._poll_tasks_worker,
-            args=(interval,),
-            daemon=True
-        )
-        self._polling_thread.start()
+        with self._polling_lock:
+            if not self._stop_polling.is_set():
+                print("Task polling is already active")
+                return False
+            
+            self._stop_polling.clear()
+            self._default_handler = default_handler
+            
+            # Create and start the polling thread
+            self._polling_thread = threading.Thread(
+                target=self._poll_tasks_worker,
+                args=(interval,),
+                daemon=True
+            )
+            self._polling_thread.start()
         print(f"Started task polling with {interval}s interval")
         return True
     
@@ -279,11 +303,12 @@ class Firebase:
         Returns:
             bool: True if polling was stopped, False if not running
         """
-        if not self._polling_active:
-            print("Task polling is not active")
-            return False
-        
-        self._polling_active = False
+        with self._polling_lock:
+            if self._stop_polling.is_set():
+                print("Task polling is not active")
+                return False
+            
+            self._stop_polling.set()
         if self._polling_thread and self._polling_thread.is_alive():
             self._polling_thread.join(timeout=1.0)
         
@@ -309,21 +334,33 @@ class Firebase:
         Args:
             interval (int): Polling interval in seconds
         """
-        while self._polling_active:
+        while not self._stop_polling.is_set():
             try:
                 tasks = self.get_tasks()
                 if tasks and isinstance(tasks, dict):
-                    for task_id, task_data in tasks.items():
-                        self._handle_task(task_id, task_data)
+                    results = {}
+                    # Highest priority first, oldest first within a priority (IDs are creation times)
+                    ordered = sorted(tasks.items(), key=lambda task: (-self._task_priority(task[1]), task[0]))
+                    for task_id, task_data in ordered:
+                        result = self._handle_task(task_id, task_data)
+                        if result is not None:
+                            results[task_id] = result
+                    # Complete everything handled this cycle in a single write
+                    self.complete_tasks(results)
             except Exception as e:
                 print(f"Error in task polling: {e}")
             
-            # Sleep for the interval
-            time_slept = 0
-            while time_slept < interval and self._polling_active:
-                time.sleep(1)
-                time_slept += 1
+            # Sleep for the interval, waking straight away if polling is stopped
+            self._stop_polling.wait(interval)
     
+    @staticmethod
+    def _task_priority(task_data):
+        """Priority of a task, 0 for tasks added without one"""
+        try:
+            return int(task_data.get('priority', 0))
+        except (AttributeError, TypeError, ValueError):
+            return 0
+
     def _handle_task(self, task_id, task_data):
         """
         Process a task with the appropriate handler
@@ -331,6 +368,9 @@ class Firebase:
         Args:
             task_id (str): ID of the task
             task_data (dict): Task data
+            
+        Returns:
+            any: The handler's result, None if the task shouldn't be completed yet
         """
         try:
             task_type = task_data.get('type')
@@ -343,21 +383,20 @@ class Firebase:
             
             if handler:
                 # Call the task-specific handler
-                result = handler(task_id, task_data)
-                # Complete the task if the handler returned a result
-                if result is not None:
-                    self.complete_task(task_id, result)
+                return handler(task_id, task_data)
             elif self._default_handler:
                 # Call the default handler
-                result = self._default_handler(task_id, task_data)
-                # Complete the task if the handler returned a result
-                if result is not None:
-                    self.complete_task(task_id, result)
+                return self._default_handler(task_id, task_data)
             else:
                 print(f"No handler registered for task type '{task_type}' and no default handler")
         except Exception as e:
             print(f"Error handling task {task_id}: {e}")
 
+@functools.cache
+def get_firebase():
+    """The shared Firebase client, created the first time it's needed rather than at import"""
+    return Firebase()
+
 # Example usage when run directly
 if __name__ == "__main__":
     import sys
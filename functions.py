@@ -3,34 +3,237 @@ from bs4 import BeautifulSoup
 import pyautogui as pg
 import time
 import pygetwindow as gw
+import pyperclip
 import os
+import subprocess
+import re
+import atexit
+import functools
+import collections
+import threading
+import httpx
+from concurrent.futures import ThreadPoolExecutor
 from selenium import webdriver
 from selenium.webdriver.common.by import By
+from selenium.webdriver.support.ui import WebDriverWait
+from selenium.webdriver.support import expected_conditions as EC
+from selenium.common.exceptions import TimeoutException, WebDriverException
 import pprint
 from openai import OpenAI
 import win32com.client
+import pythoncom
 import requests
-from firebase import Firebase
 
 #######
-fb = Firebase()
+
+# Keep connections to OpenAI open between requests so later calls skip the TLS handshake
+HTTP_LIMITS = httpx.Limits(max_keepalive_connections=20, max_connections=40, keepalive_expiry=60.0)
+HTTP_TIMEOUT = httpx.Timeout(60.0, connect=5.0)
+
+# How long tool results are reused for before they're fetched again, in seconds
+WEBSITE_CACHE_TTL = 300
+INBOX_CACHE_TTL = 30
+CONNECTIONS_CACHE_TTL = 60
+
+# netsh is only run for questions that mention the network, and is given up on after this many seconds
+NETWORK_RE = re.compile(r'network|wi-?fi|wlan|internet|connect|ssid|signal', re.IGNORECASE)
+NETSH_TIMEOUT = 5
+
+_cached_functions = []
+
+def ttl_cache(ttl, maxsize=64, cache_if=lambda result: result is not None):
+    """Reuse a function's result for the same arguments for ttl seconds, keeping the maxsize most recent.
+    Results that fail cache_if (errors) are returned but not kept"""
+    def decorator(func):
+        cache = collections.OrderedDict()
+        lock = threading.Lock()
+
+        @functools.wraps(func)
+        def wrapper(*args):
+            with lock:
+                hit = cache.get(args)
+                if hit and time.monotonic() - hit[0] < ttl:
+                    cache.move_to_end(args)
+                    return hit[1]
+            result = func(*args)
+            if cache_if(result):
+                with lock:
+                    cache[args] = (time.monotonic(), result)
+                    cache.move_to_end(args)
+                    if len(cache) > maxsize:
+                        cache.popitem(last=False)
+            return result
+
+        wrapper.cache_clear = cache.clear
+        _cached_functions.append(wrapper)
+        return wrapper
+    return decorator
+
+def clear_caches():
+    """Forget every cached tool result, so the next call fetches fresh data"""
+    for func in _cached_functions:
+        func.cache_clear()
+
+# Outlook COM constants
+OL_MAIL_ITEM = 0
+_com = threading.local()
+
+JIRA_CONTENT_CSS = "[role='main']"
+JIRA_TIMEOUT = 15
+
+EMAIL_CSS = '.S2NDX.Qo35A'
+EMAIL_CONTENT_CSS = '.g_zET'
+EMAIL_TIMEOUT_MS = 10000
+EMAIL_BATCH_SIZE = 10
+# Batches summarized at once, more would run into rate limits and the HTTP connection pool
+EMAIL_MAX_WORKERS = 8
+EMAIL_PROMPT = 'You are a helpful assistant that summarizes emails for AJ Frio. Make sure you have delimiters between each summary. Include and names dates, and times if relevant. To speed up the process, at the top of the summary put any Jira updates, and dont include Jira updates in the rest of the summary. When summarizing Jira updates, include what the task is, what was changed, and who the assignee is. If there are no Jira updates, just summarize the emails.'
+EMAIL_MERGE_PROMPT = 'You are given several partial email summaries. Merge them into a single summary without dropping any emails, following these rules: ' + EMAIL_PROMPT
+
+# Clicks each email in the list and waits for the reading pane to move off whatever it
+# showed just before the click, then grabs its text, so the whole inbox is read in one
+# WebDriver round-trip. An email that's already selected is read straight away, and one
+# whose text matches the previous pane (e.g. identical notifications) is read at the timeout
+READ_EMAILS_JS = '''
+const [itemSelector, contentSelector, timeoutMs, done] = arguments;
+const sleep = ms => new Promise(resolve => setTimeout(resolve, ms));
+const paneText = () => {
+    const content = document.querySelector(contentSelector);
+    return content ? content.innerText : null;
+};
+(async () => {
+    const texts = [];
+    for (const item of document.querySelectorAll(itemSelector)) {
+        const before = paneText();
+        if (before !== null && item.getAttribute('aria-selected') === 'true') {
+            texts.push(before);
+            continue;
+        }
+        item.click();
+        const start = Date.now();
+        let text = paneText();
+        while (Date.now() - start < timeoutMs && (text === null || text === before)) {
+            await sleep(100);
+            text = paneText();
+        }
+        if (text !== null) {
+            texts.push(text);
+        }
+    }
+    done(texts);
+})();
+'''
 
 def run_command(command):
-    """Run a command in the terminal"""
-    focus_application('powershell')
-    time.sleep(3)
-    pg.write(command)
-    pg.press('enter')
+    """Run a command in a new PowerShell window, which closes once the command finishes.
+    Returns the process so callers can wait on it"""
+    return subprocess.Popen(
+        ['powershell', '-Command', command],
+        creationflags=subprocess.CREATE_NEW_CONSOLE
+    )
+
+def chrome_options(headless: bool = False):
+    """Build Chrome options for text scraping. Pages load eagerly and skip images"""
+    options = webdriver.ChromeOptions()
+    options.page_load_strategy = 'eager'
+    options.add_experimental_option('prefs', {'profile.managed_default_content_settings.images': 2})
+    options.add_argument('--blink-settings=imagesEnabled=false')
+    if headless:
+        options.add_argument('--headless')
+        options.add_argument('--disable-gpu')
+        options.add_argument('--no-sandbox')
+        options.add_argument('--disable-dev-shm-usage')
+    return options
 
 def open_browser(url: str, keep_open: bool = False):
     """Open a browser"""
-    driver = webdriver.Chrome()
+    driver = webdriver.Chrome(options=chrome_options())
     driver.get(url)
     if not keep_open:
         driver.quit()
     else:
         return driver
 
+_headless_driver = None
+_headless_lock = threading.Lock()
+
+def get_headless_driver():
+    """Shared headless Chrome, started on first use and restarted if it has died. Hold _headless_lock while using it"""
+    global _headless_driver
+    if _headless_driver is not None:
+        try:
+            _headless_driver.current_url
+            return _headless_driver
+        except WebDriverException:
+            # Stop whatever is left of the dead browser so restarts don't pile up chromedriver processes
+            try:
+                _headless_driver.quit()
+            except WebDriverException:
+                pass
+            _headless_driver = None
+    _headless_driver = webdriver.Chrome(options=chrome_options(headless=True))
+    _headless_driver.set_page_load_timeout(10)
+    return _headless_driver
+
+@atexit.register
+def _quit_headless_driver():
+    if _headless_driver is not None:
+        _headless_driver.quit()
+
+def paste_text(text):
+    """Paste text through the clipboard, much faster than typing it key by key.
+    Whatever the user had copied is put back afterwards"""
+    previous = pyperclip.paste()
+    pyperclip.copy(text)
+    try:
+        pg.hotkey('ctrl', 'v')
+        time.sleep(0.05)
+    finally:
+        pyperclip.copy(previous)
+
+if os.name == 'nt':
+    import ctypes
+    from ctypes import wintypes
+
+    KEYEVENTF_UNICODE = 0x0004
+    KEYEVENTF_KEYUP = 0x0002
+    INPUT_KEYBOARD = 1
+
+    class _KEYBDINPUT(ctypes.Structure):
+        _fields_ = [("wVk", wintypes.WORD), ("wScan", wintypes.WORD), ("dwFlags", wintypes.DWORD),
+                    ("time", wintypes.DWORD), ("dwExtraInfo", ctypes.c_size_t)]
+
+    class _MOUSEINPUT(ctypes.Structure):
+        # Only here so INPUT has the size Windows expects, it's the largest member of the union
+        _fields_ = [("dx", wintypes.LONG), ("dy", wintypes.LONG), ("mouseData", wintypes.DWORD),
+                    ("dwFlags", wintypes.DWORD), ("time", wintypes.DWORD), ("dwExtraInfo", ctypes.c_size_t)]
+
+    class _INPUT(ctypes.Structure):
+        class _UNION(ctypes.Union):
+            _fields_ = [("ki", _KEYBDINPUT), ("mi", _MOUSEINPUT)]
+        _anonymous_ = ("u",)
+        _fields_ = [("type", wintypes.DWORD), ("u", _UNION)]
+
+def type_text(text):
+    """Type text as one batch of unicode key events, which doesn't go through the clipboard.
+    Newlines would press Enter (sending a chat message early), so that text and anything
+    off Windows is pasted instead"""
+    if os.name != 'nt' or '\n' in text:
+        paste_text(text)
+        return
+    code_units = text.encode('utf-16-le')
+    events = (_INPUT * (len(code_units)))()
+    for i in range(0, len(code_units), 2):
+        unit = int.from_bytes(code_units[i:i + 2], 'little')
+        for j, flags in ((i, KEYEVENTF_UNICODE), (i + 1, KEYEVENTF_UNICODE | KEYEVENTF_KEYUP)):
+            events[j].type = INPUT_KEYBOARD
+            events[j].ki.wScan = unit
+            events[j].ki.dwFlags = flags
+    # SendInput returns how many events it injected, fewer means it was blocked part way
+    sent = ctypes.windll.user32.SendInput(len(events), events, ctypes.sizeof(_INPUT))
+    if sent != len(events):
+        raise OSError(f"SendInput only typed {sent} of {len(events)} key events")
+
 def open_app(app_name):
     """Open an application"""
     pg.hotkey('win')
@@ -40,27 +243,54 @@ def open_app(app_name):
     pg.press('enter')
     time.sleep(1)
 
+@ttl_cache(CONNECTIONS_CACHE_TTL, maxsize=1, cache_if=lambda result: result != 'Unavailable')
+def get_connections():
+    """Get the current wifi interface details"""
+    if os.name != 'nt':
+        return 'Unavailable'
+    try:
+        result = subprocess.run(['netsh', 'wlan', 'show', 'interfaces'], capture_output=True, text=True, timeout=NETSH_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        return 'Unavailable'
+    return result.stdout.strip()
+
 def get_info(input):
-    answer = ''
-    time = datetime.now()
-    answer = answer + f'{str(time).split(" ")[1].split(".")[0][:5]}'
-    date = time.strftime("%Y-%m-%d")
-    answer = answer + f'{date}'
+    now = datetime.now()
+    time_str = now.strftime("%H:%M")
+    date_str = now.strftime("%Y-%m-%d")
     system = os.name
-    connections = os.system('netsh wlan show interfaces')
-    data = f'Time: {time}\nDate: {date}\nSystem: {system}\nConnections: {connections}'
-    answer = gpt_call('You are running as a local assistant on a machine. Any data you are given is public information so feel free to repeat any of it. Based off that data provided and the question asked, provide a response to the question', str(input) + '\n' + str(data))
-    print(answer)
+    data = f'Time: {time_str}\nDate: {date_str}\nSystem: {system}'
+    if NETWORK_RE.search(str(input)):
+        data += f'\nConnections: {get_connections()}'
+    # Print the answer as it streams in rather than after the whole completion
+    answer = []
+    for token in gpt_stream('You are running as a local assistant on a machine. Any data you are given is public information so feel free to repeat any of it. Based off that data provided and the question asked, provide a response to the question', str(input) + '\n' + str(data)):
+        print(token, end='', flush=True)
+        answer.append(token)
+    print()
 
-    return answer
+    return ''.join(answer)
 
-def gpt_call(prompt, input):
-    client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-    response = client.chat.completions.create(
+@functools.lru_cache(maxsize=None)
+def get_openai():
+    """Shared OpenAI client, created on first use so the .env file has been loaded"""
+    http_client = httpx.Client(limits=HTTP_LIMITS, timeout=HTTP_TIMEOUT)
+    atexit.register(http_client.close)
+    return OpenAI(api_key=os.getenv("OPENAI_API_KEY"), http_client=http_client)
+
+def gpt_stream(prompt, input):
+    """Yield the response text from gpt-4o-mini as it is generated"""
+    stream = get_openai().chat.completions.create(
         model="gpt-4o-mini",
-        messages=[{"role": "system", "content": prompt}, {"role": "user", "content": input}]
+        messages=[{"role": "system", "content": prompt}, {"role": "user", "content": input}],
+        stream=True
     )
-    return response.choices[0].message.content
+    for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+
+def gpt_call(prompt, input):
+    return ''.join(gpt_stream(prompt, input))
 
 def focus_application(app_name):
     """Focus on a specific application window"""
@@ -152,57 +382,42 @@ def send_message(message, person):
     find_person_teams(person, teams)
     time.sleep(1.3)
     select_chatbox(teams)
-    pg.write(message)
+    type_text(message)
     pg.press('enter')
 
+@ttl_cache(INBOX_CACHE_TTL, maxsize=1)
 def check_email():
     url = 'https://outlook.office365.com/mail/'
-    div_class = 'S2NDX Qo35A'
-    content_class = 'g_zET'
-    email_prompt = 'You are a helpful assistant that summarizes emails for AJ Frio. Make sure you have delimiters between each summary. Include and names dates, and times if relevant. To speed up the process, at the top of the summary put any Jira updates, and dont include Jira updates in the rest of the summary. When summarizing Jira updates, include what the task is, what was changed, and who the assignee is. If there are no Jira updates, just summarize the emails.'
     
     # Open browser and get URL
-    driver = webdriver.Chrome()
+    driver = webdriver.Chrome(options=chrome_options())
     driver.get(url)
     
-    # Wait for elements to load (up to 30 seconds)
-    from selenium.webdriver.support.ui import WebDriverWait
-    from selenium.webdriver.support import expected_conditions as EC
     emails = []
     
     try:
-        # Wait for and find all elements with matching class
+        # Wait for and find all elements with matching class (up to 30 seconds)
         elements = WebDriverWait(driver, 30).until(
-            EC.presence_of_all_elements_located((By.CLASS_NAME, div_class.replace(' ', '.')))
+            EC.presence_of_all_elements_located((By.CSS_SELECTOR, EMAIL_CSS))
         )
         
-        # Click each matching element and get content
-        for element in elements:
-            element.click()
-            time.sleep(0.5)  # Small delay between clicks
-            
-            # Wait for and get content
-            try:
-                content = WebDriverWait(driver, 10).until(
-                    EC.presence_of_element_located((By.CLASS_NAME, content_class))
-                )
-                content = content.text
-                content = content.encode('ascii', 'ignore').decode('ascii')
-                '''# Append content to file
-                with open('email.txt', 'a', encoding='utf-8') as f:
-                    f.write(content.text + '\n\n---\n\n')  # Add separator between emails'''
-                print(content)
-                emails.append(content)
-
-            except Exception as e:
-                print(f"Error getting content: {e}")
-                if driver:
-                    driver.quit()
+        # Click through every email and collect the reading pane text in a single script call
+        driver.set_script_timeout(EMAIL_TIMEOUT_MS / 1000 * len(elements) + 5)
+        texts = driver.execute_async_script(
+            READ_EMAILS_JS,
+            EMAIL_CSS,
+            EMAIL_CONTENT_CSS,
+            EMAIL_TIMEOUT_MS
+        )
+        for content in texts:
+            content = content.encode('ascii', 'ignore').decode('ascii')
+            print(content)
+            emails.append(content)
         
         if driver:
             driver.quit()
 
-        summary = gpt_call(email_prompt, str(emails))
+        summary = summarize_emails(emails)
 
         return summary
         
@@ -214,109 +429,111 @@ def check_email():
         if emails == []:
             return None
         else:
-            summary = gpt_call(email_prompt, str(emails))
+            summary = summarize_emails(emails)
             return summary
         
 
-def send_email(to: list, cc: list, subject: str, message: str):
-    outlook = focus_application('Outlook')
-    left, right, top, bottom, title = outlook
-    width = right - left
-    height = bottom - top
-    time.sleep(0.5)
-    if width > 1243:
-        pg.click(left + 140, top + 155)
-    else:
-        pg.click(left + 130, top + 220)
-    time.sleep(0.5)
-    for person in to:
-        pg.write(person)
-        time.sleep(1)
-        pg.press('enter')
-        time.sleep(0.5)
-    pg.press('tab')
-    time.sleep(0.5)
-    if cc != []:
-        for person in cc:
-            pg.write(person)
-            time.sleep(0.5)
-            pg.press('enter')
-            time.sleep(0.5)
-    pg.press('tab')
-    time.sleep(0.5)
-    pg.write(subject)
-    time.sleep(0.5)
-    pg.press('tab')
-    time.sleep(0.5)
-    pg.write(message)
-    time.sleep(0.5)
-    pg.press('enter')
-    time.sleep(0.5)
-    pg.hotkey('ctrl', 'enter')
-    time.sleep(0.5)
-    pg.press('enter')
+def summarize_emails(emails):
+    """Summarize emails. Long inboxes are summarized in batches in parallel, then the batch summaries are merged"""
+    if len(emails) <= EMAIL_BATCH_SIZE:
+        return gpt_call(EMAIL_PROMPT, str(emails))
+
+    batches = [emails[i:i + EMAIL_BATCH_SIZE] for i in range(0, len(emails), EMAIL_BATCH_SIZE)]
+    with ThreadPoolExecutor(max_workers=min(len(batches), EMAIL_MAX_WORKERS)) as executor:
+        partials = list(executor.map(lambda batch: gpt_call(EMAIL_PROMPT, str(batch)), batches))
+    return gpt_call(EMAIL_MERGE_PROMPT, '\n\n'.join(partials))
+
+def get_outlook():
+    """Outlook's COM object for the calling thread. COM objects can't cross threads, so each thread keeps its own"""
+    outlook = getattr(_com, 'outlook', None)
+    if outlook is None:
+        pythoncom.CoInitialize()
+        outlook = _com.outlook = win32com.client.Dispatch("Outlook.Application")
+    return outlook
 
+def parse_recipients(people):
+    """List of recipients from a comma or semicolon separated string, or an existing list"""
+    if not people:
+        return []
+    if isinstance(people, str):
+        people = re.split(r'[;,]', people)
+    return [person.strip() for person in people if person and person.strip()]
+
+def send_email(to, cc, subject: str, message: str):
+    """Send an email through Outlook directly, instead of typing it into the Outlook window"""
+    # Check the recipients before starting anything in Outlook
+    to = parse_recipients(to)
+    cc = parse_recipients(cc)
+    if not to:
+        raise ValueError("No valid recipients to send the email to")
+
+    mail = get_outlook().CreateItem(OL_MAIL_ITEM)
+    # Set each field in one COM call rather than adding recipients one at a time
+    mail.To = '; '.join(to)
+    if cc:
+        mail.CC = '; '.join(cc)
+    mail.Subject = subject
+    mail.Body = message
+    # Resolve everyone together so an unknown name still fails before sending
+    if not mail.Recipients.ResolveAll():
+        raise ValueError(f"Outlook could not resolve every recipient in {to + cc}")
+    mail.Send()
+
+@ttl_cache(INBOX_CACHE_TTL, maxsize=1)
 def check_jira():
     url = os.getenv('JIRA_URL')
-    driver = open_browser(url)
-    time.sleep(5)
-    summary = gpt_call('You are a helpful assistant that summarizes Jira tickets. Make sure you have delimiters between each summary. Include and names dates, and times if relevant. When summarizing Jira updates, include what the task is and what was changed.', driver.page_source)
-    driver.quit()
-    return summary
+    driver = open_browser(url, keep_open=True)
+    try:
+        # Jira renders its content after the page loads, wait for it rather than a fixed time
+        try:
+            WebDriverWait(driver, JIRA_TIMEOUT).until(EC.presence_of_element_located((By.CSS_SELECTOR, JIRA_CONTENT_CSS)))
+        except TimeoutException:
+            print("Timed out waiting for Jira, summarizing what has loaded")
+        return gpt_call('You are a helpful assistant that summarizes Jira tickets. Make sure you have delimiters between each summary. Include and names dates, and times if relevant. When summarizing Jira updates, include what the task is and what was changed.', driver.page_source)
+    finally:
+        # Close the window even if summarizing fails
+        driver.quit()
 
+@ttl_cache(WEBSITE_CACHE_TTL, cache_if=lambda result: not result.startswith("Error"))
 def check_website(url, context):
     try:
-        # Initialize the driver with error handling
-        options = webdriver.ChromeOptions()
-        options.add_argument('--headless')  # Run in headless mode
-        options.add_argument('--disable-gpu')
-        options.add_argument('--no-sandbox')
-        options.add_argument('--disable-dev-shm-usage')
-        
-        driver = webdriver.Chrome(options=options)
-        
-        # Add timeout for page load
-        driver.set_page_load_timeout(10)
-        
-        try:
+        # Only one page can load in the shared browser at a time
+        with _headless_lock:
+            try:
+                driver = get_headless_driver()
+            except Exception as e:
+                print(f"Error initializing WebDriver: {e}")
+                return "Error: Could not initialize web browser"
             driver.get(url)
-            
-            # Parse the page source with BeautifulSoup to extract text
-            soup = BeautifulSoup(driver.page_source, 'html.parser')
-            
-            # Remove script and style elements
-            for script in soup(["script", "style"]):
-                script.decompose()
-                
-            # Get text content and clean it up
-            text = soup.get_text()
-            # Remove extra whitespace and empty lines
-            lines = (line.strip() for line in text.splitlines())
-            text = ' '.join(chunk for chunk in lines if chunk)
-            
-            # Encode/decode to handle special characters
-            text = text.encode('ascii', 'ignore').decode('ascii')
-            
-            chat = gpt_call(f'you are used to summarize websites and look for information. Based on the question asked, respond using data from the site: {context}', text)
-            return chat
-        except Exception as e:
-            print(f"Error loading page: {e}")
-            return f"Error accessing website: {str(e)}"
-        finally:
-            # Always close the driver
-            if driver:
-                driver.quit()
-                
+            page_source = driver.page_source
     except Exception as e:
-        print(f"Error initializing WebDriver: {e}")
-        return "Error: Could not initialize web browser"
+        print(f"Error loading page: {e}")
+        return f"Error accessing website: {str(e)}"
+
+    # Parse the page source with BeautifulSoup to extract text
+    soup = BeautifulSoup(page_source, 'html.parser')
+    
+    # Remove script and style elements
+    for script in soup(["script", "style"]):
+        script.decompose()
+        
+    # Get text content and clean it up
+    text = soup.get_text()
+    # Remove extra whitespace and empty lines
+    lines = (line.strip() for line in text.splitlines())
+    text = ' '.join(chunk for chunk in lines if chunk)
+    
+    # Encode/decode to handle special characters
+    text = text.encode('ascii', 'ignore').decode('ascii')
+    
+    return gpt_call(f'you are used to summarize websites and look for information. Based on the question asked, respond using data from the site: {context}', text)
 
 def use_cursor(prompt):
     focus_application('Cursor')
     time.sleep(.5)
     pg.hotkey('ctrl', 'l')
     time.sleep(.4)
-    pg.write(prompt)
+    type_text(prompt)
     time.sleep(.3)
     pg.press('enter')
 
@@ -1,17 +1,19 @@
 import pyautogui
 import anthropic
-import base64
+import asyncio
+import functools
 from typing import List, Dict, Any, Optional
 import logging
-import json
+import orjson
 import time
-from PIL import Image
-import io
+from PIL import Image, ImageChops
 import time
 import dotenv
 import os
 import socket
+import sys
 from funcList import funclist
+import screen
 
 memory = []
 
@@ -19,29 +21,77 @@ name = socket.gethostname()
 
 dotenv.load_dotenv()
 
+MODEL = "claude-3-5-sonnet-20241022"
+MAX_TOKENS = 1024
+BETAS = ["computer-use-2024-10-22"]
+BATCH_POLL_START = 20
+BATCH_POLL_MAX = 300
+# The agent loop retries rate limits, overloads and dropped connections itself, this many times in a row
+MAX_RETRIES = 5
+# Changes covering more of the screen than this are sent as a full screenshot
+MAX_CROP_FRACTION = 0.4
+
+# The screen size doesn't change while we run, so query the display server once at import.
+# Screenshots are shrunk to fit screen.MAX_EDGE, so Claude works in that coordinate space
+SCREEN_WIDTH, SCREEN_HEIGHT = (int(n) for n in pyautogui.size())
+DISPLAY_SIZE = screen.fit_size((SCREEN_WIDTH, SCREEN_HEIGHT))
+DISPLAY_SCALE = DISPLAY_SIZE[0] / SCREEN_WIDTH
+
+# The tools are fixed, so build them once at import
+TOOLS = (
+    {
+        "type": "computer_20241022",
+        "name": "computer",
+        "display_width_px": DISPLAY_SIZE[0],
+        "display_height_px": DISPLAY_SIZE[1],
+        "display_number": 1,
+    },
+    {
+        "type": "text_editor_20241022", 
+        "name": "str_replace_editor"
+    },
+    {
+        "type": "bash_20241022",
+        "name": "bash"
+    },
+    *funclist
+)
+
+
+@functools.lru_cache(maxsize=None)
+def get_client(api_key: str) -> anthropic.AsyncAnthropic:
+    """One client per API key, so every agent shares the same connection pool"""
+    return anthropic.AsyncAnthropic(api_key=api_key)
+
+
+def _retry_after(error: anthropic.APIError) -> float:
+    """Seconds the API asked us to wait before retrying, 1 if it didn't say or the header can't be read"""
+    response = getattr(error, "response", None)
+    try:
+        return float(response.headers.get("retry-after", 1))
+    except (AttributeError, TypeError, ValueError):
+        return 1.0
+
+
+def _without_images(value: Any) -> Any:
+    """Copy of a message structure with base64 image data replaced by its size, for logging"""
+    if isinstance(value, list):
+        return [_without_images(item) for item in value]
+    if isinstance(value, dict):
+        if value.get("type") == "base64" and "data" in value:
+            return {**value, "data": f"<{len(value['data'])} bytes>"}
+        return {key: _without_images(item) for key, item in value.items()}
+    return value
+
 
 class ComputerUseAgent:
     def __init__(self, api_key: str):
         self.prime = '***If using a web browser, close any popups or notifications.*** /n *** When navigating around the computer, try to use the builtin tools to open apps. If the tools dont provide the right actions, then use mouse and keyboard inputs*** /n ***After each step, take a screenshot and carefully evaluate if you have achieved the right outcome. Explicitly show your thinking: "I have evaluated step X..." If not correct, try again. Only when you confirm a step was executed correctly should you move on to the next one.***'
-        self.client = anthropic.Anthropic(api_key=api_key)
-        self.tools = [
-            {
-                "type": "computer_20241022",
-                "name": "computer",
-                "display_width_px": int(pyautogui.size()[0]),
-                "display_height_px": int(pyautogui.size()[1]),
-                "display_number": 1,
-            },
-            {
-                "type": "text_editor_20241022", 
-                "name": "str_replace_editor"
-            },
-            {
-                "type": "bash_20241022",
-                "name": "bash"
-            }
-        ]
-        self.tools.extend(funclist)
+        self.client = get_client(api_key)
+        # The agent loop backs off itself, so the SDK shouldn't also retry underneath it
+        self._loop_client = self.client.with_options(max_retries=0)
+
+        self.tools = TOOLS
 
         logging.basicConfig(
             level=logging.INFO,
@@ -49,48 +99,83 @@ class ComputerUseAgent:
         )
         self.logger = logging.getLogger(__name__)
 
-    def take_screenshot(self) -> Dict[str, Any]:
-        """Take a screenshot and return it as a base64 encoded image"""
-        try:
-            screenshot = pyautogui.screenshot()
-            buffered = io.BytesIO()
-            screenshot.save(buffered, format="PNG")
-            img_str = base64.b64encode(buffered.getvalue()).decode()
-            
-            result = {
-                "type": "image",
-                "source": {
-                    "type": "base64",
-                    "media_type": "image/png",
-                    "data": img_str
-                }
+        # Previous screenshot, so later ones only need to send what changed
+        self._last_frame = None
+        self._last_image = None
+
+    def _reset_screenshots(self):
+        """Forget the previous screenshot, a new conversation has never seen it"""
+        self._last_frame = None
+        self._last_image = None
+
+    def _image_block(self, image: Image.Image) -> Dict[str, Any]:
+        return {
+            "type": "image",
+            "source": {
+                "type": "base64",
+                "media_type": "image/jpeg",
+                "data": screen.to_base64(image)
             }
-            print(f"Screenshot taken")
-            return result
+        }
+
+    def take_screenshot(self) -> List[Dict[str, Any]]:
+        """Take a screenshot and return content blocks with only what changed since the last one"""
+        try:
+            screenshot = screen.capture()
+            # Comparing the raw pixels is a single memcmp that stops at the first difference,
+            # cheaper than hashing the whole frame
+            frame = screenshot.tobytes()
+            if frame == self._last_frame:
+                self.logger.debug("Screenshot unchanged")
+                return [{"type": "text", "text": "The screen has not changed since the last screenshot."}]
+
+            image = screen.fit(screenshot, DISPLAY_SIZE)
+            previous = self._last_image
+            self._last_frame = frame
+            self._last_image = image
+
+            # Small changes (typed text, a menu opening) only send the changed region
+            bbox = ImageChops.difference(image, previous).getbbox() if previous is not None else None
+            if bbox:
+                left, top, right, bottom = bbox
+                width, height = DISPLAY_SIZE
+                if (right - left) * (bottom - top) < MAX_CROP_FRACTION * width * height:
+                    self.logger.debug("Screenshot taken, sending changed region %s", bbox)
+                    return [
+                        {
+                            "type": "text",
+                            "text": f"Only the region that changed since the last screenshot is shown: left={left}, top={top}, width={right - left}, height={bottom - top} of the {width}x{height} screen."
+                        },
+                        self._image_block(image.crop(bbox))
+                    ]
+
+            self.logger.debug("Screenshot taken")
+            return [self._image_block(image)]
         except Exception as e:
             self.logger.error(f"Screenshot error: {str(e)}")
             raise
 
-    def execute_computer_action(self, action: Dict[str, Any]) -> Dict[str, Any]:
+    def _to_screen(self, coordinate: List[int]) -> tuple:
+        """Map a coordinate on the downscaled screenshot back to the real screen"""
+        return round(coordinate[0] / DISPLAY_SCALE), round(coordinate[1] / DISPLAY_SCALE)
+
+    def execute_computer_action(self, action: Dict[str, Any]) -> List[Dict[str, Any]]:
         """Execute a computer action (mouse/keyboard)"""
         try:
             action_type = action.get("action")
-            print(f"Executing computer action: {action}")
+            self.logger.debug("Executing computer action: %s", action_type)
             
             if action_type == "left_click":
                 pyautogui.click()
                 time.sleep(0.5)  # Wait for click to register
-                print(f"****LEFT CLICKED****")
             
             elif action_type == "double_click":
                 pyautogui.doubleClick()
                 time.sleep(0.5)  # Wait for click to register
-                print(f"****DOUBLE CLICKED****")
 
             elif action_type == "right_click":
                 pyautogui.rightClick()
                 time.sleep(0.5)  # Wait for click to register
-                print(f"****RIGHT CLICKED****")
                 
             elif action_type == "type":
                 text = action.get("text", "")
@@ -106,16 +191,16 @@ class ComputerUseAgent:
                 time.sleep(0.1)
                 
             elif action_type == "mouse_move":
-                x, y = action.get("coordinate", [0, 0])[0], action.get("coordinate", [0, 0])[1]
+                x, y = self._to_screen(action.get("coordinate", [0, 0]))
                 pyautogui.moveTo(x=x, y=y)
                 time.sleep(0.1)
-                print(f"Moved to {x}, {y}")
+                self.logger.debug("Moved to %d, %d", x, y)
 
             elif action_type == "left_click_drag":
-                x, y = action.get("coordinate", [0, 0])[0], action.get("coordinate", [0, 0])[1]
+                x, y = self._to_screen(action.get("coordinate", [0, 0]))
                 pyautogui.dragTo(x=x, y=y, button='left')
                 time.sleep(0.1)
-                print(f"Dragged to {x}, {y}")
+                self.logger.debug("Dragged to %d, %d", x, y)
                 
             # Take a screenshot after any action
             return self.take_screenshot()
@@ -128,19 +213,14 @@ class ComputerUseAgent:
         """Process a tool use request from Claude"""
         try:
             self.logger.info(f"Processing tool use: {tool_use.name}")
-            print(f"Processing tool use: {tool_use}")
             
             if tool_use.name == "computer":
                 result = self.execute_computer_action(tool_use.input)
             else:
                 raise ValueError(f"Unsupported tool: {tool_use.name}")
-            if result['type'] == "image":
-                print(f"Screenshot taken (second confirmation)")
-            else:
-                print(f"Tool use result: {result}")
             # Return the content of the tool result
             return {
-                "content": [result]
+                "content": result
             }
             
         except Exception as e:
@@ -149,81 +229,165 @@ class ComputerUseAgent:
                 "content": f"Error: {str(e)}",
                 "is_error": True
             }
-            print(f"Tool use error result: {error_result}")
             return error_result
 
-    def run_agent_loop(self, user_input: str) -> str:
-        """Run the agent loop to process user input and handle tool use"""
-        messages = [{"role": "user", "content": self.prime + "\n\n" + user_input}]
-        print(f"Initial messages: {json.dumps(messages, indent=2)}")
-        
+    async def _apply_response(self, messages: List[Dict[str, Any]], response: Any) -> Optional[str]:
+        """Append Claude's tool use and its result to messages, or return the final text"""
+        if response.stop_reason != "tool_use":
+            # Final response from Claude
+            return response.content[0].text
+
+        for content in response.content:
+            if content.type == "tool_use":
+                # Assistant message indicating tool use
+                tool_use_message = {
+                    "role": "assistant",
+                    "content": [
+                        {
+                            "type": "tool_use",
+                            "id": content.id,
+                            "name": content.name,
+                            "input": content.input
+                        }
+                    ]
+                }
+                messages.append(tool_use_message)
+                
+                # Process the tool use off the event loop, pyautogui blocks
+                tool_result = await asyncio.to_thread(self.process_tool_use, content)
+                
+                # Add tool result as a user message
+                messages.append({
+                    "role": "user",
+                    "content": [
+                        {
+                            "type": "tool_result",
+                            "tool_use_id": content.id,
+                            "content": tool_result["content"],
+                            "is_error": tool_result.get("is_error", False)
+                        }
+                    ]
+                })
+                break
+        return None
+
+    async def _continue_agent_loop(self, messages: List[Dict[str, Any]]) -> str:
+        """Keep sending the conversation to Claude until it stops asking for tools"""
+        retries = 0
         while True:
             try:
-                print("Sending request to Claude...")
-                response = self.client.beta.messages.create(
-                    model="claude-3-5-sonnet-20241022",
-                    max_tokens=1024,
+                response = await self._loop_client.beta.messages.create(
+                    model=MODEL,
+                    max_tokens=MAX_TOKENS,
                     tools=self.tools,
                     messages=messages,
-                    betas=["computer-use-2024-10-22"],
+                    betas=BETAS,
                 )
-                print(f"Received response from Claude: {response}")
+                self.logger.debug("Received response: stop_reason=%s content_blocks=%d", response.stop_reason, len(response.content))
+                retries = 0
                 
-                if response.stop_reason == "tool_use":
-                    for content in response.content:
-                        if content.type == "tool_use":
-                            # Assistant message indicating tool use
-                            tool_use_message = {
-                                "role": "assistant",
-                                "content": [
-                                    {
-                                        "type": "tool_use",
-                                        "id": content.id,
-                                        "name": content.name,
-                                        "input": content.input
-                                    }
-                                ]
-                            }
-                            messages.append(tool_use_message)
-                            
-                            # Process the tool use
-                            tool_result = self.process_tool_use(content)
-                            
-                            # Add tool result as a user message
-                            messages.append({
-                                "role": "user",
-                                "content": [
-                                    {
-                                        "type": "tool_result",
-                                        "tool_use_id": content.id,
-                                        "content": tool_result["content"],
-                                        "is_error": tool_result.get("is_error", False)
-                                    }
-                                ]
-                            })
-                            break
-                else:
-                    # Final response from Claude
-                    return response.content[0].text
+                result = await self._apply_response(messages, response)
+                if result is not None:
+                    return result
+
+            except (anthropic.RateLimitError, anthropic.InternalServerError, anthropic.APIConnectionError) as e:
+                # Wait as long as Anthropic asks, backing off further on repeats
+                if retries >= MAX_RETRIES:
+                    self.logger.error(f"Agent loop error: {str(e)}")
+                    return f"An error occurred: {str(e)}"
+                delay = max(_retry_after(e), 2 ** retries)
+                retries += 1
+                self.logger.warning(f"{type(e).__name__}, retrying in {delay}s")
+                await asyncio.sleep(delay)
                     
             except Exception as e:
                 self.logger.error(f"Agent loop error: {str(e)}")
                 return f"An error occurred: {str(e)}"
-            time.sleep(3.5)
+
+    async def run_agent_loop(self, user_input: str) -> str:
+        """Run the agent loop to process user input and handle tool use"""
+        messages = [{"role": "user", "content": self.prime + "\n\n" + user_input}]
+        self._reset_screenshots()
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(f"Initial messages: {orjson.dumps(_without_images(messages), option=orjson.OPT_INDENT_2).decode()}")
+        return await self._continue_agent_loop(messages)
+
+    async def run_agent_batch(self, user_inputs: List[str]) -> List[str]:
+        """Send the first turn of every request through the Message Batches API (half price,
+        not interactive), then finish any conversation that needs tools in the normal loop"""
+        conversations = [[{"role": "user", "content": self.prime + "\n\n" + user_input}] for user_input in user_inputs]
+        batch = await self.client.beta.messages.batches.create(
+            requests=[
+                {
+                    "custom_id": str(index),
+                    "params": {
+                        "model": MODEL,
+                        "max_tokens": MAX_TOKENS,
+                        "tools": self.tools,
+                        "messages": messages,
+                    }
+                }
+                for index, messages in enumerate(conversations)
+            ],
+            betas=BETAS,
+        )
+        self.logger.info("Created message batch %s", batch.id)
+
+        # Batches take minutes, so back off between status checks
+        delay = BATCH_POLL_START
+        while batch.processing_status != "ended":
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, BATCH_POLL_MAX)
+            batch = await self.client.beta.messages.batches.retrieve(batch.id)
+
+        responses = {}
+        async for entry in await self.client.beta.messages.batches.results(batch.id):
+            responses[int(entry.custom_id)] = entry.result
+
+        # Tool use drives the shared screen, so the follow-up turns run one conversation at a time
+        results = []
+        for index, messages in enumerate(conversations):
+            result = responses.get(index)
+            if result is None or result.type != "succeeded":
+                results.append(f"An error occurred: batch request {result.type if result else 'missing'}")
+                continue
+            self._reset_screenshots()
+            text = await self._apply_response(messages, result.message)
+            if text is None:
+                text = await self._continue_agent_loop(messages)
+            results.append(text)
+        return results
 
 def main():
     # Read API key from file
     api_key = os.getenv("ANTHROPIC_API_KEY")
         
     agent = ComputerUseAgent(api_key)
+
+    # Batch mode, collect every request first and submit them together
+    if '--batch' in sys.argv:
+        user_inputs = []
+        while True:
+            user_input = input("Enter a request (or 'q' to submit the batch): ")
+            if user_input.lower() == 'q':
+                break
+            user_inputs.append(user_input)
+        if user_inputs:
+            for user_input, result in zip(user_inputs, asyncio.run(agent.run_agent_batch(user_inputs))):
+                print(f"\n{user_input}\nClaude's response: {result}")
+        return
     
     # Example usage
+    asyncio.run(interactive(agent))
+
+async def interactive(agent: ComputerUseAgent):
+    # One event loop for the whole session, the client's pooled connections belong to it
     while True:
-        user_input = input("Enter your request (or 'q' to exit): ")
+        user_input = await asyncio.to_thread(input, "Enter your request (or 'q' to exit): ")
         if user_input.lower() == 'q':
             break
             
-        result = agent.run_agent_loop(user_input)
+        result = await agent.run_agent_loop(user_input)
         print("\nClaude's response:", result)
 
 if __name__ == "__main__":
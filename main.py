@@ -1,34 +1,52 @@
-import pyautogui
-import time
 import os
 from dotenv import load_dotenv
 import openai
-import base64
-from io import BytesIO
-import json
+import httpx
+import orjson
+import asyncio
+import threading
+import concurrent.futures
+import queue
+import subprocess
 import tkinter as tk
 from tkinter import ttk, scrolledtext
-import pyperclip
 import functions as f
+import screen
 from funcList import funclist
 from learn import ComputerUseAgent
+from firebase import get_firebase
 import random
-from firebase import Firebase
+import re
+import logging
+import inspect
+import functools
+import platform
+import collections
+import time
+import tiktoken
 
 # Load environment variables from .env file
 load_dotenv()
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
 tools = funclist
-client = openai.OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+aclient = openai.AsyncOpenAI(
+    api_key=os.getenv("OPENAI_API_KEY"),
+    http_client=httpx.AsyncClient(limits=f.HTTP_LIMITS, timeout=f.HTTP_TIMEOUT)
+)
+# OpenAI requests run on this loop in the background so Tk never waits on the network
+loop = asyncio.new_event_loop()
+threading.Thread(target=loop.run_forever, name="openai-loop", daemon=True).start()
 name = "CAS-E"
 id = "(Central Automated System - Epic)"
-fb = Firebase()  # Create an instance of the Firebase class
+fb = get_firebase()
 fb.update_status("on")
 computers = fb.get_all_computers()
 
 # Define task handlers for Firebase polling
 def handle_command_task(task_id, task_data):
     """Handle a command execution task"""
-    print(f"Executing command: {task_data}")
+    logger.info("Executing command: %s", task_data)
     params = task_data.get('params')
     
     # Handle both string params and dictionary params
@@ -41,13 +59,13 @@ def handle_command_task(task_id, task_data):
         command = None
         
     if command:
-        result = f.run_command(command)
-        return {"command_result": result}
+        process = f.run_command(command)
+        return {"command_result": f"Started with pid {process.pid}"}
     return {"error": "No command provided"}
 
 def handle_open_app_task(task_id, task_data):
     """Handle an open app task"""
-    print(f"Opening app: {task_data}")
+    logger.info("Opening app: %s", task_data)
     params = task_data.get('params')
     
     # Handle both string params and dictionary params
@@ -67,8 +85,8 @@ def handle_open_app_task(task_id, task_data):
 def handle_default_task(task_id, task_data):
     """Default handler for unrecognized tasks"""
     task_type = task_data.get('type', 'unknown')
-    print(f"Received unhandled task type: {task_type}")
-    print(f"Task data: {task_data}")
+    logger.info("Received unhandled task type: %s", task_type)
+    logger.debug("Task data: %s", task_data)
     return {"status": "acknowledged", "task_id": task_id}
 
 # Register task handlers
@@ -78,9 +96,10 @@ fb.register_task_handler("open_app", handle_open_app_task)
 # Start task polling in the background
 fb.start_task_polling(interval=300, default_handler=handle_default_task)
 
-systemPrompt = f'''
+# Sent with every request, so the indentation and surrounding blank lines are stripped
+systemPrompt = inspect.cleandoc(f'''
     You are virtual assistant called {name} {id} developed by AJ Frio.
-    \n
+
     You will be given a set of tools to use to complete the task. Only use a tool if it is apporpriate for the requested task. If required, you will also be given an image for context.
     If callinng any of the following tools, only call one, never stack these tools: 
     - send_message
@@ -90,11 +109,11 @@ systemPrompt = f'''
     - send_email
     - check_jira
     - use_cursor
-    \n
+
     Keep all responses short and direct.
     If the user asks for a task that is required to be completed by another computer, use the add_task_to_computer tool.
     Here are the availabe computers: {computers}
-'''
+''')
 
 greetings = [
     "Hello AJ",
@@ -104,31 +123,143 @@ greetings = [
     "Meoooooowwww"
 ]
 
+# Speech recognition isn't supported on ARM64
+IS_ARM64 = platform.machine().upper() in ("ARM64", "AARCH64")
+
+# Any of these anywhere in the input means a screenshot should go with it, one pass over the text
+IMAGE_RE = re.compile(r'screen|see|look|show|image|pic|read|document|chat|ask', re.IGNORECASE)
+# How many text answers are kept for repeated questions, and for how many seconds
+RESPONSE_CACHE_SIZE = 500
+RESPONSE_CACHE_TTL = 600
+# Asking for a refresh skips the cached website, email and Jira results
+REFRESH_RE = re.compile(r'refresh', re.IGNORECASE)
+
+# Tools that can't overlap, by the lock they share. Ones that drive the keyboard, mouse or focused
+# window run one at a time
+_input_lock = threading.Lock()
+SERIAL_TOOLS = {
+    "send_message": _input_lock,
+    "open_app": _input_lock,
+    "use_cursor": _input_lock,
+}
+# Tools whose output is kept in the chat history for later turns
+REMEMBERED_TOOLS = {"check_website"}
+# How long run_command waits for a command to finish before reporting it as still running, in seconds
+COMMAND_TIMEOUT = 30
+
+# Tool handlers run on worker threads and return the text to display
+def handle_send_message(args):
+    f.send_message(args['message'], args['person'])
+    return f"Message to {args['person']}: {args['message']}"
+
+def handle_open_app(args):
+    f.focus_application(args['app_name'])
+    return f"Opened {args['app_name']}"
+
+def handle_check_email(args):
+    return f.check_email()
+
+def handle_get_info(args):
+    return f.get_info(args['input'])
+
+def handle_send_email(args):
+    f.send_email(args['people'], args.get('cc'), args['subject'], args['message'])
+    return f"Email sent to {args['people']} with subject {args['subject']}"
+
+def handle_check_jira(args):
+    return f.check_jira()
+
+def handle_use_cursor(args):
+    f.use_cursor(args['prompt'])
+    return "Cursor request sent"
+
+def handle_check_website(args):
+    return f.check_website(args['url'], args['context'])
+
+def handle_run_command(args):
+    # Wait on the process so it's reaped and its exit code can be reported
+    process = f.run_command(args['command'])
+    try:
+        code = process.wait(timeout=COMMAND_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        return f"Command still running (pid {process.pid}): {args['command']}"
+    return f"Command run: {args['command']} (exit code {code})"
+
+def handle_add_task_to_computer(args):
+    fb.add_task_to_computer(args['target_computer'], args['task_type'], args['task_params'])
+    return f"Task added to {args['target_computer']}"
+
+TOOL_HANDLERS = {
+    "send_message": handle_send_message,
+    "open_app": handle_open_app,
+    "check_email": handle_check_email,
+    "get_info": handle_get_info,
+    "send_email": handle_send_email,
+    "check_jira": handle_check_jira,
+    "use_cursor": handle_use_cursor,
+    "check_website": handle_check_website,
+    "run_command": handle_run_command,
+    "add_task_to_computer": handle_add_task_to_computer,
+}
+
+def run_tool(tool_name, args):
+    """Run a tool handler, first waiting for any tool it can't overlap with to finish"""
+    handler = TOOL_HANDLERS[tool_name]
+    lock = SERIAL_TOOLS.get(tool_name)
+    if lock:
+        with lock:
+            return handler(args)
+    return handler(args)
+
+# Chat history is resent every turn, so keep it to the most recent messages and
+# summarize the oldest half once it gets too long
+HISTORY_MAX_MESSAGES = 40
+HISTORY_MAX_TOKENS = 6000
+HISTORY_SUMMARY_PROMPT = 'Summarize the following conversation in 200 words, keeping any names, dates and requests that may come up again.'
+_encoder = tiktoken.encoding_for_model("gpt-4o-mini")
+
+# The system prompt never changes, so build its message and count its tokens once.
+# With the tools it makes a stable prefix OpenAI can cache between requests, as long as
+# the computers list it includes stays the same (it's only read at startup)
+PROMPT_CACHE_KEY = f"{name}-system-v1"
+SYSTEM_MESSAGE = {"role": "system", "content": systemPrompt}
+SYSTEM_TOKENS = len(_encoder.encode(systemPrompt))
+
+@functools.lru_cache(maxsize=1024)
+def count_tokens(text):
+    """Token count of text, cached since the same history messages are counted every turn"""
+    return len(_encoder.encode(text))
+
+def estimate_tokens(messages):
+    """Rough token count of the system prompt plus the text in messages"""
+    return SYSTEM_TOKENS + sum(count_tokens(message["content"]) for message in messages if isinstance(message["content"], str))
+
+async def summarize_history(messages):
+    """Runs on the background loop. Condense old chat history into a single message"""
+    conversation = '\n'.join(f"{message['role']}: {message['content']}" for message in messages)
+    response = await aclient.chat.completions.create(
+        model="gpt-4o-mini",
+        messages=[{"role": "system", "content": HISTORY_SUMMARY_PROMPT}, {"role": "user", "content": conversation}]
+    )
+    return {"role": "system", "content": "Prior context: " + response.choices[0].message.content}
+
 def typeText(text):
-    pyperclip.copy(text)
-    pyautogui.hotkey('ctrl', 'v')
-    time.sleep(0.1)
-    pyperclip.copy('')
-    #pyautogui.write(text)
+    f.type_text(text)
 
 def displayResponse(text):
-    print(text)
+    logger.info(text)
 
 def getImage():
-    # Take screenshot
-    image = pyautogui.screenshot()
-    
-    # Convert to base64
-    buffered = BytesIO()
-    image.save(buffered, format="PNG")
-    img_str = base64.b64encode(buffered.getvalue()).decode()
-    
-    return img_str
+    return screen.to_data_url(screen.fit(screen.capture()))
 
 class AssistantGUI:
-    chat_history = []
-
     def __init__(self, root):
+        # Per window, so a second GUI doesn't share or resend this one's conversation
+        self.chat_history = collections.deque(maxlen=HISTORY_MAX_MESSAGES)
+        self._summarizing = False
+        # (time, answer) by the exact input and the reply it followed, least recently used first
+        self._response_cache = collections.OrderedDict()
+
         self.root = root
         self.root.title(id)
         self.root.geometry("1000x600")
@@ -178,13 +309,13 @@ class AssistantGUI:
         self.input_field.grid(row=1, column=0, sticky=(tk.W, tk.E), padx=(0, 10), pady=10)
 
         # Send button with matching theme
-        send_button = ttk.Button(
+        self.send_button = ttk.Button(
             main_frame,
             text="Send",
             command=self.process_input,
             style="Custom.TButton"
         )
-        send_button.grid(row=1, column=1, sticky=(tk.E))
+        self.send_button.grid(row=1, column=1, sticky=(tk.E))
 
         # Add Voice Mode checkbox
         self.voice_mode_var = tk.BooleanVar()
@@ -206,135 +337,295 @@ class AssistantGUI:
         # Bind enter key to process_input
         self.input_field.bind("<Return>", lambda e: self.process_input())
 
+        # Every blocking call (screenshots, listening, tools) runs on this pool through the background loop
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=8, thread_name_prefix="cas-e")
+        loop.call_soon_threadsafe(loop.set_default_executor, self._pool)
+        self.root.protocol("WM_DELETE_WINDOW", self._on_close)
+
+        # Whether a request is in flight, input is ignored until it finishes so replies don't overlap
+        self._busy = False
+        # Whether a streamed response is currently being written to the chat display
+        self._streaming = False
+
+        # Created the first time voice mode is used
+        self.recognizer = None
+        self.microphone = None
+
         #Start it :)
         self.display_message(random.choice(greetings))
 
+    def _on_close(self):
+        # Drop anything still queued so closing the window doesn't wait on it
+        self._pool.shutdown(wait=False, cancel_futures=True)
+        self.root.destroy()
+
     def display_message(self, message):
         self.chat_display.insert(tk.END, message + "\n\n")
         self.chat_display.see(tk.END)
 
+    def _set_busy(self, busy):
+        """Disable the entry and Send button while a request is in flight"""
+        self._busy = busy
+        state = ["disabled"] if busy else ["!disabled"]
+        self.input_field.state(state)
+        self.send_button.state(state)
+
     def process_input(self):
-        if self.voice_mode_var.get() and os.system('echo %PROCESSOR_ARCHITECTURE%') != 'ARM64':
+        if self._busy:
+            return
+        if self.voice_mode_var.get() and not IS_ARM64:
             import speech_recognition as sr
-            # Initialize speech recognizer
-            self.recognizer = sr.Recognizer()
-            self.microphone = sr.Microphone()
-
-            # Use speech recognition to get input
-            with self.microphone as source:
-                self.display_message(f"{name}: Listening...")
-                audio = self.recognizer.listen(source)
-                try:
-                    user_input = self.recognizer.recognize_google(audio)
-                    self.display_message(f"You (voice): {user_input}")
-                except sr.UnknownValueError:
-                    self.display_message(f"{name}: Sorry, I did not understand that.")
-                    return
-                except sr.RequestError:
-                    self.display_message(f"{name}: Sorry, there was an error with the speech recognition service.")
-                    return
-        else:
-            # Use text input
-            user_input = self.input_field.get()
-            if not user_input:
-                return
-            self.display_message(f"You: {user_input}")
-            self.input_field.delete(0, tk.END)
+            # Initialize speech recognizer once, opening the microphone enumerates every audio device
+            if self.recognizer is None:
+                self.recognizer = sr.Recognizer()
+                self.microphone = sr.Microphone()
+
+            # Listening and transcribing run in the background so the window stays responsive
+            self.display_message(f"{name}: Listening...")
+            self._set_busy(True)
+            future = asyncio.run_coroutine_threadsafe(asyncio.to_thread(self._listen), loop)
+            self._poll_future(future, self._on_transcript, self._on_speech_error)
+            return
+
+        # Use text input
+        user_input = self.input_field.get()
+        if not user_input:
+            return
+        self.display_message(f"You: {user_input}")
+        self.input_field.delete(0, tk.END)
+        self._set_busy(True)
+        self._send(user_input)
+
+    def _listen(self):
+        """Runs on a worker thread. Record one utterance and transcribe it, None if it wasn't understood"""
+        import speech_recognition as sr
+        with self.microphone as source:
+            audio = self.recognizer.listen(source)
+        try:
+            return self.recognizer.recognize_google(audio)
+        except sr.UnknownValueError:
+            return None
+
+    def _on_transcript(self, user_input):
+        if not user_input:
+            self.display_message(f"{name}: Sorry, I did not understand that.")
+            self._set_busy(False)
+            return
+        self.display_message(f"You (voice): {user_input}")
+        self._send(user_input)
+
+    def _on_speech_error(self, error):
+        self.display_message(f"{name}: Sorry, there was an error with the speech recognition service.")
+        self._set_busy(False)
+
+    def _send(self, user_input):
+        # Check if image is needed based on keywords, and if so start the screenshot straight away
+        # so it's taken while the rest of the request is put together
+        image = None
+        if IMAGE_RE.search(user_input):
+            image = asyncio.run_coroutine_threadsafe(asyncio.to_thread(getImage), loop)
+        logger.debug("image_needed=%s", image is not None)
+        if REFRESH_RE.search(user_input):
+            f.clear_caches()
+            self._response_cache.clear()
+
+        # Text-only questions that were answered recently in the same context are answered again from the cache
+        cache_key = self._cache_key(user_input) if image is None else None
+        cached = self._response_cache.get(cache_key)
+        if cached and time.monotonic() - cached[0] > RESPONSE_CACHE_TTL:
+            del self._response_cache[cache_key]
+            cached = None
+        if cached:
+            self._response_cache.move_to_end(cache_key)
+            reply = cached[1]
+            self.chat_history.append({"role": "user", "content": user_input})
+            self.chat_history.append({"role": "assistant", "content": reply})
+            self.display_message(f"\n{name}: {reply}")
+            self._set_busy(False)
+            return
 
         self.display_message(f"{name}: Generating...")
-        self.root.update()
-
-        # Check if image is needed based on keywords
-        image_keywords = ['screen', 'see', 'look', 'show', 'image', 'pic', 'read', 'document', 'chat', 'ask', ]
-        needs_image = any(keyword in user_input.lower() for keyword in image_keywords)
-        if needs_image:
-            print("Image needed")
-        else:
-            print("No image needed")
 
         # Prepare messages
-        messages = [
-            {"role": "system", "content": systemPrompt}
-        ]
+        messages = [SYSTEM_MESSAGE]
         
         # Add chat history
         messages.extend(self.chat_history)
-        
-        # Add current user message
+
+        self.chat_history.append({"role": "user", "content": user_input})
+
+        # Screenshot and OpenAI request run on the background loop so the window stays responsive,
+        # streamed text comes back through chunks as it's generated
+        chunks = queue.SimpleQueue()
+        future = asyncio.run_coroutine_threadsafe(self._request_response(messages, user_input, image, chunks), loop)
+        self._poll_stream(future, chunks, cache_key)
+
+    def _cache_key(self, user_input):
+        """Key an answer by the input and the last reply, so follow-ups like "why?" aren't answered from another conversation"""
+        previous = next((message["content"] for message in reversed(self.chat_history) if message["role"] == "assistant"), None)
+        return previous, user_input
+
+    async def _request_response(self, messages, user_input, image, chunks):
+        """Runs on the background loop. Adds the user message (with the screenshot if one was taken) and streams
+        the response from OpenAI, putting text into chunks. Returns the full text and the (name, arguments) tool calls, with the arguments parsed here
+        so malformed ones fail through _on_error instead of on the Tk thread"""
         messages.append({
             "role": "user", 
-            "content": user_input if not needs_image else [
+            "content": user_input if image is None else [
                 {"type": "text", "text": user_input},
-                {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{getImage()}"}}
+                {"type": "image_url", "image_url": {"url": await asyncio.wrap_future(image)}}
             ]
         })
-
-        self.chat_history.append({"role": "user", "content": user_input})
-
-        # Process with OpenAI
-        response = client.chat.completions.create(
+        stream = await aclient.chat.completions.create(
             model="gpt-4o-mini",
             messages=messages,
-            tools=tools
+            tools=tools,
+            stream=True,
+            extra_body={"prompt_cache_key": PROMPT_CACHE_KEY}
         )
-        
-        # Remove the "Generating..." message (including the extra newlines)
-        self.chat_display.delete('end-3c linestart', 'end')
+        content = []
+        tool_calls = {}
+        async for chunk in stream:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta
+            if delta.content:
+                content.append(delta.content)
+                chunks.put(delta.content)
+            # Tool calls arrive in fragments, keyed by their index
+            for tool_call in delta.tool_calls or ():
+                call = tool_calls.setdefault(tool_call.index, ["", ""])
+                if tool_call.function and tool_call.function.name:
+                    call[0] += tool_call.function.name
+                if tool_call.function and tool_call.function.arguments:
+                    call[1] += tool_call.function.arguments
+        return ''.join(content), [(tool_name, orjson.loads(arguments)) for tool_name, arguments in tool_calls.values()]
+
+    def _poll_stream(self, future, chunks, cache_key):
+        """Show streamed text as it arrives, then hand the finished response to _on_response"""
+        # Check before draining, everything is queued by the time the future is done
+        done = future.done()
+        text = []
+        while not chunks.empty():
+            text.append(chunks.get())
+        if text:
+            if not self._streaming:
+                # Replace "Generating..." with the start of the response
+                self.chat_display.delete('end-3c linestart', 'end')
+                self.chat_display.insert(tk.END, f"\n{name}: ")
+                self._streaming = True
+            self.chat_display.insert(tk.END, ''.join(text))
+            self.chat_display.see(tk.END)
+        if done:
+            self._poll_future(future, lambda response: self._on_response(response, cache_key))
+        else:
+            self.root.after(50, self._poll_stream, future, chunks, cache_key)
+
+    def _poll_future(self, future, callback, on_error=None):
+        """Wait for a background future without blocking Tk, then run callback with its result on the Tk thread"""
+        if not future.done():
+            self.root.after(50, self._poll_future, future, callback, on_error)
+            return
+        error = future.exception()
+        if error:
+            logger.error("Error getting response: %s", error)
+            (on_error or self._on_error)(error)
+        else:
+            try:
+                callback(future.result())
+            except Exception as callback_error:
+                # Don't leave the input disabled if handling the result fails
+                logger.exception("Error handling response")
+                (on_error or self._on_error)(callback_error)
+
+    def _on_error(self, error):
+        if self._streaming:
+            # Keep the partial reply, just end its line
+            self._streaming = False
+            self.chat_display.insert(tk.END, "\n")
+        else:
+            # Remove the "Generating..." message
+            self.chat_display.delete('end-3c linestart', 'end')
+        self.display_message(f"\n{name}: Sorry, something went wrong: {error}")
+        self._set_busy(False)
+
+    def _on_response(self, response, cache_key=None):
+        content, tool_calls = response
+        if self._streaming:
+            # The text is already on screen, just finish it off
+            self._streaming = False
+            self.chat_display.insert(tk.END, "\n\n")
+            self.chat_display.see(tk.END)
+        else:
+            # Remove the "Generating..." message (including the extra newlines)
+            self.chat_display.delete('end-3c linestart', 'end')
         
         # Process response
-        if not response.choices[0].message.content:
-            # Define the function handlers dictionary
-            tool_handlers = {
-                "send_message": lambda args: (
-                    f.send_message(args['message'], args['person']),
-                    self.display_message(f"{name}: Message to {args['person']}: {args['message']}")
-                ),
-                "open_app": lambda args: (
-                    f.focus_application(args['app_name']),
-                    self.display_message(f"\n{name}: Opened {args['app_name']}")
-                ),
-                "check_email": lambda args: (
-                    self.display_message(f"\n{name}: {f.check_email()}")
-                ),
-                "get_info": lambda args: (
-                    self.display_message(f"\n{name}: {f.get_info(args['input'])}")
-                ),
-                "send_email": lambda args: (
-                    f.send_email(args['people'], args['cc'], args['subject'], args['message']),
-                    self.display_message(f"\n{name}: Email sent to {args['people']} with subject {args['subject']}")
-                ),
-                "check_jira": lambda args: (
-                    self.display_message(f"\n{name}: {f.check_jira()}")
-                ),
-                "use_cursor": lambda args: (
-                    f.use_cursor(args['prompt']),
-                    self.display_message(f"\n{name}: Cursor request sent")
-                ),
-                "check_website": lambda args: (
-                    self.chat_history.append({"role": "assistant", "content": f.check_website(args['url'], args['context'])}),
-                    self.display_message(f"\n{name}: {f.check_website(args['url'], args['context'])}")
-                ),
-                "run_command": lambda args: (
-                    f.run_command(args['command']),
-                    self.display_message(f"\n{name}: Command run: {args['command']}")
-                ),
-                'add_task_to_computer': lambda args: (
-                    fb.add_task_to_computer(args['target_computer'], args['task_type'], args['task_params']),
-                    self.display_message(f"\n{name}: Task added to {args['target_computer']}")
-                )
-            }
-
+        if not content:
             # Handle all tool calls
-            for tool_call in response.choices[0].message.tool_calls:
-                self.chat_history.append({"role": "assistant", "content": tool_call.function.name})
-                args = json.loads(tool_call.function.arguments)
-                
-                # Execute the appropriate handler
-                if tool_call.function.name in tool_handlers:
-                    tool_handlers[tool_call.function.name](args)
+            calls = []
+            for tool_name, arguments in tool_calls:
+                self.chat_history.append({"role": "assistant", "content": tool_name})
+                if tool_name in TOOL_HANDLERS:
+                    calls.append((tool_name, arguments))
+
+            self.display_message(f"{name}: Generating...")
+            future = asyncio.run_coroutine_threadsafe(self._run_tools(calls), loop)
+            self._poll_future(future, lambda results: self._on_tool_results(calls, results))
         else:
-            self.display_message(f"\n{name}: {response.choices[0].message.content}")
-            self.chat_history.append({"role": "assistant", "content": response.choices[0].message.content})
+            self.chat_history.append({"role": "assistant", "content": content})
+            # Only text answers are cached, tool calls have side effects that need to run again
+            if cache_key is not None:
+                self._response_cache[cache_key] = (time.monotonic(), content)
+                if len(self._response_cache) > RESPONSE_CACHE_SIZE:
+                    self._response_cache.popitem(last=False)
+            self._set_busy(False)
+            self._trim_history()
+
+    async def _run_tools(self, calls):
+        """Runs on the background loop. Independent tools run at the same time instead of one after another,
+        a failing tool comes back as its exception so the others' results are still shown"""
+        return await asyncio.gather(*(
+            asyncio.to_thread(run_tool, tool_name, args)
+            for tool_name, args in calls
+        ), return_exceptions=True)
+
+    def _on_tool_results(self, calls, results):
+        self.chat_display.delete('end-3c linestart', 'end')
+        texts = []
+        for (tool_name, args), result in zip(calls, results):
+            if isinstance(result, Exception):
+                logger.error("Error running %s: %s", tool_name, result)
+                texts.append(f"\n{name}: Sorry, {tool_name} failed: {result}")
+                continue
+            if tool_name in REMEMBERED_TOOLS:
+                self.chat_history.append({"role": "assistant", "content": result})
+            texts.append(f"\n{name}: {result}")
+        # One insert and scroll for all the results instead of one per tool
+        self.display_message("\n\n".join(texts))
+        self._set_busy(False)
+        self._trim_history()
+
+    def _trim_history(self):
+        """Start summarizing the oldest half of the chat history once it's over the token budget"""
+        if self._summarizing or estimate_tokens(self.chat_history) <= HISTORY_MAX_TOKENS:
+            return
+        self._summarizing = True
+        old = list(self.chat_history)[:len(self.chat_history) // 2]
+        future = asyncio.run_coroutine_threadsafe(summarize_history(old), loop)
+        self._poll_future(future, lambda summary: self._on_history_summary(old, summary), self._on_history_error)
+
+    def _on_history_error(self, error):
+        # The history just stays as it is until the next try
+        self._summarizing = False
+
+    def _on_history_summary(self, old, summary):
+        self._summarizing = False
+        # Only drop the messages that were summarized, in case the deque has moved on since
+        for message in old:
+            if self.chat_history and self.chat_history[0] is message:
+                self.chat_history.popleft()
+        self.chat_history.appendleft(summary)
 
 
 def main():
@@ -0,0 +1,56 @@
+import base64
+import threading
+from io import BytesIO
+import pyautogui
+from PIL import Image
+
+# Vision models resize anything with a longer edge than this, so there's no point sending more pixels
+MAX_EDGE = 1568
+
+# Reused for every encode so the buffer isn't regrown from empty each screenshot
+_buffer = BytesIO()
+_buffer_lock = threading.Lock()
+
+def capture():
+    """Take a screenshot of the whole screen"""
+    return pyautogui.screenshot()
+
+def fit_size(size, max_edge=MAX_EDGE):
+    """Get the size an image should be shrunk to so its long edge fits max_edge"""
+    width, height = size
+    long_edge = max(width, height)
+    if long_edge <= max_edge:
+        return width, height
+    # Integer math rounded to nearest, so the short edge isn't truncated a pixel short
+    half = long_edge // 2
+    return (width * max_edge + half) // long_edge, (height * max_edge + half) // long_edge
+
+def fit(image, size=None, resample=Image.BILINEAR):
+    """Shrink an image to size, or so its long edge fits MAX_EDGE, bilinear is plenty for a model's eyes"""
+    size = size or fit_size(image.size)
+    if image.size != size:
+        # Box-reduce by whole factors first so the filter only runs over the last small step
+        image = image.resize(size, resample, reducing_gap=2.0)
+    return image
+
+def _encode(image):
+    """Encode an image as base64 JPEG bytes, far cheaper to encode and upload than PNG"""
+    with _buffer_lock:
+        # Overwrite from the start and only read back what was written, truncating would shrink the buffer
+        _buffer.seek(0)
+        # convert() always copies, even when the image is already RGB
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        image.save(_buffer, format="JPEG", quality=75)
+        size = _buffer.tell()
+        # Encode straight from the buffer instead of copying it out with getvalue()
+        with _buffer.getbuffer() as view, view[:size] as data:
+            return base64.b64encode(data)
+
+def to_base64(image):
+    """Encode an image as a base64 JPEG string"""
+    return _encode(image).decode("ascii")
+
+def to_data_url(image):
+    """Encode an image as a JPEG data URL, joining the prefix as bytes so there's only one string copy"""
+    return (b"data:image/jpeg;base64," + _encode(image)).decode("ascii")